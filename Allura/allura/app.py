@@ -19,9 +19,10 @@ import os
 import logging
 from urllib.parse import urljoin
 from io import BytesIO
-from collections import defaultdict
+from collections import defaultdict, ChainMap
 from xml.etree import ElementTree as ET
 from copy import copy
+from functools import lru_cache
 
 import pkg_resources
 from markupsafe import Markup
@@ -57,12 +58,27 @@ log = logging.getLogger(__name__)
 config = ConfigProxy(common_suffix='forgemail.domain')
 
 
+@lru_cache(maxsize=4096)
+def _urljoin(base, url):
+    # sitemaps are re-bound for every tool on every page render, with the same
+    # handful of (app url, relative url) pairs
+    return urljoin(base, url)
+
+
+def _as_list(value):
+    # form fields come through as a plain str when only one value was submitted
+    return [value] if isinstance(value, str) else list(value)
+
+
 class ConfigOption:
 
     """Definition of a configuration option for an :class:`Application`.
 
     """
 
+    __slots__ = ('name', 'ming_type', '_default', 'label', 'help_text', 'validator', 'extra_attrs',
+                 'has_callable_default')
+
     def __init__(self, name, ming_type, default,
                  label=None, help_text=None, validator=None,
                  extra_attrs=None):
@@ -72,13 +88,14 @@ class ConfigOption:
         self.help_text = help_text
         self.validator = validator
         self.extra_attrs = extra_attrs
+        self.has_callable_default = callable(default)
 
     @property
     def default(self):
         """Return the default value for this ConfigOption.
 
         """
-        if callable(self._default):
+        if self.has_callable_default:
             return self._default()
         return self._default
 
@@ -101,6 +118,9 @@ class SitemapEntry:
 
     """
 
+    __slots__ = ('label', 'className', 'url', 'small', 'ui_icon', 'children', 'tool_name', 'mount_point',
+                 'matching_urls', 'extra_html_attrs')
+
     def __init__(self, label, url=None, children=None, className=None,
                  ui_icon=None, small=None, tool_name=None, matching_urls=None, extra_html_attrs=None, mount_point=None):
         """
@@ -161,20 +181,25 @@ class SitemapEntry:
         :returns: :class:`SitemapEntry`
 
         """
+        return self._bind_app(app, app.url, app.config.options.mount_point)
+
+    def _bind_app(self, app, app_url, mount_point):
+        # app_url and mount_point are looked up once by bind_app and passed
+        # down, rather than re-read from app for every entry in the tree
         lbl = self.label
         url = self.url
         if callable(lbl):
             lbl = lbl(app)
         if url is not None:
-            url = urljoin(app.url, url)
+            url = _urljoin(app_url, url)
         return SitemapEntry(lbl, url,
-                            [ch.bind_app(app) for ch in self.children],
+                            [ch._bind_app(app, app_url, mount_point) for ch in self.children],
                             className=self.className,
                             ui_icon=self.ui_icon,
                             small=self.small,
                             tool_name=self.tool_name,
                             matching_urls=self.matching_urls,
-                            mount_point=app.config.options.mount_point,
+                            mount_point=mount_point,
                             extra_html_attrs=self.extra_html_attrs,
                             )
 
@@ -203,8 +228,8 @@ class SitemapEntry:
         """Return True if this SitemapEntry 'matches' the url of ``request``.
 
         """
-        return self.url in request.upath_info or any([
-            url in request.upath_info for url in self.matching_urls])
+        path = request.upath_info
+        return self.url in path or any(url in path for url in self.matching_urls)
 
     def __json__(self):
         return dict(
@@ -290,6 +315,8 @@ class Application(ActivityObject):
         'configure': 'Set label and options. Requires admin permission.',
         'admin': 'Set permissions.',
     }
+    _permissions_desc_cache = {}  # ChainMap over the MRO's permissions_desc, keyed by class
+    _default_options_cache = {}  # (config_options, static defaults, callable options), keyed by class
     max_instances = float("inf")
     searchable = False
     exportable = False
@@ -384,9 +411,10 @@ class Application(ActivityObject):
         Returns empty string if there is no description for ``permission``.
 
         """
-        d = {}
-        for t in reversed(cls.__mro__):
-            d = dict(d, **getattr(t, 'permissions_desc', {}))
+        d = cls._permissions_desc_cache.get(cls)
+        if d is None:
+            d = cls._permissions_desc_cache[cls] = ChainMap(
+                *[getattr(t, 'permissions_desc', {}) for t in cls.__mro__])
         return d.get(permission, '')
 
     def parent_security_context(self):
@@ -491,11 +519,20 @@ class Application(ActivityObject):
     def is_visible_to(self, user):
         """Return True if ``user`` can view this app.
 
+        The result is cached in the request's
+        :class:`~allura.lib.security.Credentials`, since the project sitemap
+        checks every tool, often more than once per page.
+
         :type user: :class:`allura.model.User` instance
         :rtype: bool
 
         """
-        return has_access(self, 'read', user)
+        cache = g.credentials.app_visibility
+        key = (self.config._id, user._id)
+        visible = cache.get(key)
+        if visible is None:
+            visible = cache[key] = bool(has_access(self, 'read', user))
+        return visible
 
     def subscribe_admins(self):
         """Subscribe all project Admins (for this Application's project) to the
@@ -540,9 +577,22 @@ class Application(ActivityObject):
         :rtype: dict
 
         """
-        return {
-            co.name: co.default
-            for co in cls.config_options}
+        cached = cls._default_options_cache.get(cls)
+        if cached is None or cached[0] is not cls.config_options:
+            static_defaults = {}
+            callable_options = []
+            for co in cls.config_options:
+                if co.has_callable_default:
+                    callable_options.append(co)
+                else:
+                    static_defaults[co.name] = co._default
+            cached = (cls.config_options, static_defaults, callable_options)
+            cls._default_options_cache[cls] = cached
+        _, static_defaults, callable_options = cached
+        options = dict(static_defaults)
+        for co in callable_options:
+            options[co.name] = co.default
+        return options
 
     @classmethod
     def options_on_install(cls):
@@ -573,8 +623,17 @@ class Application(ActivityObject):
         # De-index all the artifacts belonging to this tool in one fell swoop
         index_tasks.solr_del_tool.post(project_id, self.config.options['mount_point'])
 
-        for d in model.Discussion.query.find({'app_config_id': self.config._id}):
-            d.delete()
+        # Remove the tool's discussions in bulk, instead of having each
+        # Discussion.delete() cascade through its threads and posts one by one
+        app_config_id = {'app_config_id': self.config._id}
+        model.DiscussionAttachment.remove(app_config_id)  # also removes the stored files
+        model.Post.query.remove(app_config_id)
+        model.PostHistory.query.remove(app_config_id)
+        model.Thread.query.remove(app_config_id)
+        model.Discussion.query.remove(app_config_id)
+        # Artifact.delete() would also have dropped their refs and shortlinks
+        model.ArtifactReference.query.remove({'artifact_reference.app_config_id': self.config._id})
+        model.Shortlink.query.remove(app_config_id)
         self.config.delete()
         session(self.config).flush()
 
@@ -659,8 +718,7 @@ class Application(ActivityObject):
         :return: a list of :class:`SitemapEntries <allura.app.SitemapEntry>`
 
         """
-        admin_url = c.project.url() + 'admin/' + \
-            self.config.options.mount_point + '/'
+        admin_url = f'{c.project.url()}admin/{self.config.options.mount_point}/'
         links = []
         if self.permissions and has_access(c.project, 'admin'):
             links.append(
@@ -725,10 +783,11 @@ class Application(ActivityObject):
         thd, parent_id = artifact.get_discussion_thread(message)
         # Handle attachments
         message_id = message['message_id']
+        payload = message['payload']
         if message.get('filename'):
             # Special case - the actual post may not have been created yet
             log.info('Saving attachment %s', message['filename'])
-            fp = BytesIO(six.ensure_binary(message['payload']))
+            fp = BytesIO(six.ensure_binary(payload))
             self.AttachmentClass.save_attachment(
                 message['filename'], fp,
                 content_type=message.get(
@@ -745,7 +804,7 @@ class Application(ActivityObject):
                 'Existing message_id %s found - saving this as text attachment' %
                 message_id)
 
-            fp = BytesIO(six.ensure_binary(message['payload']))
+            fp = BytesIO(six.ensure_binary(payload))
             post.attach(
                 'alternate', fp,
                 content_type=message.get(
@@ -754,7 +813,7 @@ class Application(ActivityObject):
                 thread_id=thd._id,
                 post_id=message_id)
         else:
-            text = six.ensure_text(message['payload']) or '--no text body--'
+            text = six.ensure_text(payload) or '--no text body--'
             post = thd.post(
                 message_id=message_id,
                 parent_id=parent_id,
@@ -883,6 +942,7 @@ class DefaultAdminController(BaseController, AdminControllerMixin):
         ace = model.ACE.deny(model.ProjectRole.by_user(user, upsert=True)._id, perm, reason)
         if not model.ACL.contains(ace, self.app.acl):
             self.app.acl.append(ace)
+            g.credentials.clear_app_visibility(self.app.config._id)
             model.AuditLog.log('{}: blocked user "{}" from permission "{}" for reason: "{}"'.format(
                 self.app.config.options['mount_point'],
                 username,
@@ -910,6 +970,7 @@ class DefaultAdminController(BaseController, AdminControllerMixin):
             ace = model.ACL.contains(ace, self.app.acl)
             if ace:
                 self.app.acl.remove(ace)
+                g.credentials.clear_app_visibility(self.app.config._id)
                 unblocked.append(str(user._id))
                 model.AuditLog.log('{}: unblocked user "{}" from permission "{}"'.format(
                     self.app.config.options['mount_point'],
@@ -929,18 +990,24 @@ class DefaultAdminController(BaseController, AdminControllerMixin):
         c.block_user = BlockUser()
         c.block_list = BlockList()
         permissions = {p: [] for p in self.app.permissions}
-        block_list = defaultdict(list)
+        deny_aces = []
         for ace in self.app.config.acl:
             if ace.access == model.ACE.ALLOW:
-                try:
-                    permissions[ace.permission].append(ace.role_id)
-                except KeyError:
-                    # old, unknown permission
-                    pass
+                role_ids = permissions.get(ace.permission)
+                if role_ids is not None:  # skip old, unknown permissions
+                    role_ids.append(ace.role_id)
             elif ace.access == model.ACE.DENY:
-                role = model.ProjectRole.query.get(_id=ace.role_id)
-                if role and role.name is None and role.user:
-                    block_list[ace.permission].append((role.user, ace.reason))
+                deny_aces.append(ace)
+        # load the roles of all blocked users in one query, rather than one per deny ACE
+        roles = {}
+        if deny_aces:
+            roles = {r._id: r for r in model.ProjectRole.query.find(
+                {'_id': {'$in': list({ace.role_id for ace in deny_aces})}})}
+        block_list = defaultdict(list)
+        for ace in deny_aces:
+            role = roles.get(ace.role_id)
+            if role and role.name is None and role.user:
+                block_list[ace.permission].append((role.user, ace.reason))
         return dict(
             app=self.app,
             allow_config=has_access(c.project, 'admin'),
@@ -1043,48 +1110,70 @@ class DefaultAdminController(BaseController, AdminControllerMixin):
 
         """
         old_acl = self.app.config.acl
-        self.app.config.acl = []
+        # group the old ACEs by permission once, instead of rescanning the whole ACL for every card
+        old_role_ids = defaultdict(list)
+        old_deny_aces = defaultdict(list)
+        for ace in old_acl:
+            if ace.access == model.ACE.DENY:
+                old_deny_aces[ace.permission].append(ace)
+            else:
+                old_role_ids[ace.permission].append(str(ace.role_id))
+
+        perm_cards = []
         for args in card:
             perm = args['id']
-            new_group_ids = args.get('new', [])
-            del_group_ids = []
-            group_ids = args.get('value', [])
-            if isinstance(new_group_ids, str):
-                new_group_ids = [new_group_ids]
-            if isinstance(group_ids, str):
-                group_ids = [group_ids]
-
-            for acl in old_acl:
-                if (acl['permission'] == perm
-                        and str(acl['role_id']) not in group_ids
-                        and acl['access'] != model.ACE.DENY):
-                    del_group_ids.append(str(acl['role_id']))
-
-            def get_role(_id):
-                return model.ProjectRole.query.get(_id=ObjectId(_id))
-            groups = list(map(get_role, group_ids))
-            new_groups = list(map(get_role, new_group_ids))
-            del_groups = list(map(get_role, del_group_ids))
-
-            def group_names(groups):
-                return ', '.join((role.name or '<Unnamed>') for role in groups if role)
-
-            if new_groups or del_groups:
+            new_group_ids = _as_list(args.get('new', []))
+            group_ids = _as_list(args.get('value', []))
+            kept_ids = set(group_ids)
+            del_group_ids = [_id for _id in old_role_ids[perm] if _id not in kept_ids]
+            perm_cards.append((perm, group_ids, new_group_ids, del_group_ids))
+
+        role_oids = {}
+        logged_oids = set()
+        for perm, group_ids, new_group_ids, del_group_ids in perm_cards:
+            changed = new_group_ids or del_group_ids
+            for ids in (group_ids, new_group_ids, del_group_ids):
+                for _id in ids:
+                    if _id not in role_oids:
+                        role_oids[_id] = ObjectId(_id)
+                    if changed:
+                        logged_oids.add(role_oids[_id])
+        # role names are only needed for the audit log of changed cards; look them all up in a single query
+        roles = {}
+        if logged_oids:
+            roles = {r._id: r for r in model.ProjectRole.query.find(
+                {'_id': {'$in': list(logged_oids)}})}
+
+        def get_roles(ids):
+            return [roles.get(role_oids[_id]) for _id in ids]
+
+        def group_names(groups):
+            return ', '.join((role.name or '<Unnamed>') for role in groups if role)
+
+        new_acl = []
+        for perm, group_ids, new_group_ids, del_group_ids in perm_cards:
+            if new_group_ids or del_group_ids:
+                groups = get_roles(group_ids)
                 model.AuditLog.log('updated "{}" permission: "{}" => "{}" for {}'.format(
                     perm,
-                    group_names(groups + del_groups),
-                    group_names(groups + new_groups),
+                    group_names(groups + get_roles(del_group_ids)),
+                    group_names(groups + get_roles(new_group_ids)),
                     self.app.config.options['mount_point']))
 
-            role_ids = list(map(ObjectId, group_ids + new_group_ids))
-            self.app.config.acl += [
-                model.ACE.allow(r, perm) for r in role_ids]
+            new_acl += [
+                model.ACE.allow(role_oids[_id], perm) for ids in (group_ids, new_group_ids) for _id in ids]
 
             # Add all ACEs for user roles back
-            for ace in old_acl:
-                if (ace.permission == perm) and (ace.access == model.ACE.DENY):
-                    self.app.config.acl.append(ace)
-        g.post_event('project_menu_updated')  # since 'read' permission changes can affect what is visible in menu
+            new_acl += old_deny_aces[perm]
+
+        # a re-POST of unchanged permissions shouldn't rewrite the ACL
+        def ace_keys(acl):
+            return [(ace.access, ace.role_id, ace.permission, ace.reason) for ace in acl]
+
+        if ace_keys(new_acl) != ace_keys(old_acl):
+            self.app.config.acl = new_acl
+            g.credentials.clear_app_visibility(self.app.config._id)
+            g.post_event('project_menu_updated')  # since 'read' permission changes can affect what is visible in menu
         redirect(six.ensure_text(request.referer or '/'))
 
 
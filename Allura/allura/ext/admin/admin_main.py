@@ -1060,6 +1060,7 @@ class PermissionsController(BaseController):
             role_ids = list(map(ObjectId, group_ids + new_group_ids))
             permissions[perm] = role_ids
         c.project.acl = []
+        g.credentials.clear_app_visibility()
         for perm, role_ids in permissions.items():
             def role_names(ids): return ','.join(sorted(
                 pr.name for pr in M.ProjectRole.query.find(dict(_id={'$in': ids}))))
@@ -1177,6 +1178,7 @@ class GroupsController(BaseController):
             M.AuditLog.log('revoked permission %s from group %s', permission,
                            M.ProjectRole.query.get(_id=ObjectId(role_id)).name)
             c.project.acl.remove(M.ACE.allow(ObjectId(role_id), permission))
+        g.credentials.clear_app_visibility()
         g.post_event('project_updated')
         return self._map_group_permissions()
 
@@ -317,6 +317,7 @@ def make_app_admin_only(app):
     admin_role = ProjectRole.by_name('Admin', app.project)
     for ace in [ace for ace in app.acl if ace.role_id != admin_role._id]:
         app.acl.remove(ace)
+    g.credentials.clear_app_visibility(app.config._id)
 
 
 @contextmanager
@@ -16,9 +16,12 @@
 #       under the License.
 
 import re
+import time
 import logging
 import smtplib
 import email.parser
+from functools import lru_cache
+from collections.abc import Mapping
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email import header
@@ -37,17 +40,32 @@ from allura.lib import helpers as h
 
 log = logging.getLogger(__name__)
 
-RE_MESSAGE_ID = re.compile(r'<(?:[^>]*/)?([^>]*)>')
+# <[path/]id>, an id can't contain '/' and neither part '<' so a match never scans past the next bracket
+RE_MESSAGE_ID = re.compile(r'<(?:[^<>]*/)?([^<>/]*)>')
 config = ConfigProxy(
     common_suffix='forgemail.domain',
     common_suffix_alt='forgemail.domain.alternates',
     return_path='forgemail.return_path',
 )
 EMAIL_VALIDATOR = fev.Email(not_empty=True)
+# EMAIL_VALIDATOR's username and domain rules in one pattern, for ascii addresses
+RE_EMAIL = re.compile(r"[\w!#$%&'*+\-/=?^`{|}~.]+@"
+                      r"(?:[a-z0-9][a-z0-9\-]{,62}\.)+(?:[a-z]{2,63}|xn--[a-z0-9\-]{2,59})",
+                      re.IGNORECASE | re.ASCII)
 
 # http://www.jebriggs.com/blog/2010/07/smtp-maximum-line-lengths/
 MAX_MAIL_LINE_OCTETS = 990
 
+# inbound messages are fed to the parser in chunks of this size
+PARSE_CHUNK_SIZE = 64 * 1024
+# and outbound ones are written to the smtp socket in chunks of about this size
+SMTP_DATA_CHUNK_SIZE = 64 * 1024
+
+# parse_address remembers which project & tool an address path resolved to, for this many seconds
+ADDRESS_CACHE_TTL = 60
+ADDRESS_CACHE_SIZE = 1024
+_address_cache = {}
+
 email_policy = email.policy.SMTP + email.policy.strict
 
 def Header(text, *more_text) -> str:
@@ -62,12 +80,10 @@ def Header(text, *more_text) -> str:
     if not isinstance(text, str):
         raise TypeError('This must be unicode: %r' % text)
 
-    hdr_text = text
     for m in more_text:
         if not isinstance(m, str):
-            raise TypeError('This must be unicode: %r' % text)
-        hdr_text += ' ' + m
-    return hdr_text
+            raise TypeError('This must be unicode: %r' % m)
+    return ' '.join((text,) + more_text) if more_text else text
 
 def AddrHeader(fromaddr) -> str:
     '''Accepts any of:
@@ -75,8 +91,8 @@ def AddrHeader(fromaddr) -> str:
         foo@bar.com
         "Foo Bar" <foo@bar.com>
     '''
-    if isinstance(fromaddr, str) and ' <' in fromaddr:
-        name, addr = fromaddr.rsplit(' <', 1)
+    name, sep, addr = fromaddr.rpartition(' <') if isinstance(fromaddr, str) else ('', '', '')
+    if sep:
         addr = '<' + addr  # restore the char we just split off
         addrheader = Header(name, addr)
         if str(addrheader).startswith('=?'):  # encoding escape chars
@@ -88,6 +104,18 @@ def AddrHeader(fromaddr) -> str:
     return addrheader
 
 
+# header values which mark a message as an autoreply
+AUTOREPLY_HEADERS = (
+    ('Auto-Submitted', ('auto-replied',)),
+    ('X-POST-MessageClass', ('9; Autoresponder',)),
+    ('Delivered-To', ('Autoresponder',)),
+    ('X-FC-MachineGenerated', ('true',)),
+    ('X-Autogenerated', ('Forward', 'Group', 'Letter', 'Mirror', 'Redirect', 'Reply')),
+    ('X-Precedence', ('auto_reply',)),
+    ('Return-Path', ('<>',)),
+)
+
+
 def is_autoreply(msg):
     '''Returns True, if message is an autoreply
 
@@ -96,27 +124,44 @@ def is_autoreply(msg):
     '''
     h = msg['headers']
     return (
-        h.get('Auto-Submitted') == 'auto-replied'
-        or h.get('X-POST-MessageClass') == '9; Autoresponder'
-        or h.get('Delivered-To') == 'Autoresponder'
-        or h.get('X-FC-MachineGenerated') == 'true'
-        or h.get('X-AutoReply-From') is not None
-        or h.get('X-Autogenerated') in ['Forward', 'Group', 'Letter', 'Mirror', 'Redirect', 'Reply']
-        or h.get('X-Precedence') == 'auto_reply'
-        or h.get('Return-Path') == '<>'
+        h.get('X-AutoReply-From') is not None
+        or any(h.get(name) in values for name, values in AUTOREPLY_HEADERS)
     )
 
 
+@lru_cache(maxsize=8)
+def _cached_aslist(value) -> tuple:
+    # for config values that are read on every message, but rarely change
+    return tuple(aslist(value))
+
+
 def parse_address(addr):
     userpart, domain = addr.split('@')
     # remove common domain suffix
-    for suffix in [config.common_suffix] + aslist(config.common_suffix_alt):
-        if domain.endswith(suffix):
-            domain = domain[:-len(suffix)]
-            break
-    else:
+    suffixes = (config.common_suffix,) + _cached_aslist(config.common_suffix_alt)
+    if not domain.endswith(suffixes):
         raise exc.AddressException('Unknown domain: ' + domain)
+    suffix = next(s for s in suffixes if domain.endswith(s))
+    domain = domain[:-len(suffix)]
     path = '/'.join(reversed(domain.split('.')))
+    project, app = _resolve_address_path(path, domain)
+    return userpart, project, app
+
+
+def _resolve_address_path(path, domain):
+    from allura import model as M
+
+    cached = _address_cache.get(path)
+    if cached and time.monotonic() - cached[0] < ADDRESS_CACHE_TTL:
+        # only ids are cached, the objects belong to the session of whoever looked them up
+        _, project_id, app_config_id, mount_point = cached
+        project = M.Project.query.get(_id=project_id, deleted=False)
+        app_config = M.AppConfig.query.get(_id=app_config_id, project_id=project_id)
+        if project and app_config and app_config.options.mount_point == mount_point:
+            with h.push_config(c, project=project):
+                app = project.app_instance(app_config)
+            if app:
+                return project, app
     project, mount_point = h.find_project('/' + path)
     if project is None:
         raise exc.AddressException('Unknown project: ' + domain)
@@ -126,23 +171,32 @@ def parse_address(addr):
         app = project.app_instance(mount_point[0])
         if not app:
             raise exc.AddressException('Unknown tool: ' + domain)
-    return userpart, project, app
+    if len(_address_cache) >= ADDRESS_CACHE_SIZE:
+        _address_cache.clear()
+    _address_cache[path] = (time.monotonic(), project._id, app.config._id, mount_point[0])
+    return project, app
 
 
 def parse_message(data):
-    # Parse the email to its constituent parts
+    # Parse the email (bytes, or str as loaded from a mongo task) to its constituent parts
 
     # https://bugs.python.org/issue25545 says
     # > A unicode string has no RFC defintion as an email, so things do not work right...
     # > You do have to conditionalize your 2/3 code to use the bytes parser and generator if you are dealing with 8-bit
     # > messages. There's just no way around that.
-    # works the same as BytesFeedParser, and better than non-"Bytes" parsers for some messages
-    parser = email.parser.BytesParser()
-    msg = parser.parsebytes(data.encode('utf-8'))
+    # works the same as BytesParser, and better than non-"Bytes" parsers for some messages.  Feeding it in chunks avoids
+    # BytesParser's decoded copy of the whole message
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    parser = email.parser.BytesFeedParser()
+    for start in range(0, len(data), PARSE_CHUNK_SIZE):
+        parser.feed(data[start:start + PARSE_CHUNK_SIZE])
+    msg = parser.close()
     # Extract relevant data
-    result = {}
-    result['multipart'] = multipart = msg.is_multipart()
-    result['headers'] = dict(msg)
+    multipart = msg.is_multipart()
+    result = {} if multipart else _ParsedPart(msg)
+    result['multipart'] = multipart
+    result['headers'] = _HeaderView(msg)
     result['message_id'] = _parse_message_id(msg.get('Message-ID'))
     result['in_reply_to'] = _parse_message_id(msg.get('In-Reply-To'))
     result['references'] = _parse_message_id(msg.get('References'))
@@ -153,53 +207,163 @@ def parse_message(data):
     if multipart:
         result['parts'] = []
         for part in msg.walk():
-            dpart = dict(
-                headers=dict(part),
+            dpart = _ParsedPart(
+                part,
+                headers=_HeaderView(part),
                 message_id=result['message_id'],
                 in_reply_to=result['in_reply_to'],
                 references=result['references'],
                 content_type=part.get_content_type(),
-                filename=part.get_filename(None),
-                payload=part.get_payload(decode=True))
-            # payload is sometimes already unicode (due to being saved in mongo?)
-            if part.get_content_maintype() == 'text':
-                dpart['payload'] = six.ensure_text(dpart['payload'])
+                filename=part.get_filename(None))
             result['parts'].append(dpart)
-    else:
-        result['payload'] = msg.get_payload(decode=True)
-        # payload is sometimes already unicode (due to being saved in mongo?)
-        if msg.get_content_maintype() == 'text':
-            result['payload'] = six.ensure_text(result['payload'])
 
     return result
 
 
+class _HeaderView(Mapping):
+
+    """Read-only mapping of a parsed email's headers.  Only the header values
+    are kept, not the message, so its body can be freed.
+
+    Like ``dict(msg)`` did, a repeated header maps to its first value.
+    Unlike it, lookups ignore case, as they do on the message itself.
+
+    """
+
+    __slots__ = ('_names', '_values')
+
+    def __init__(self, msg):
+        items = msg.items()
+        # names in order of first appearance, as dict(msg) had them
+        self._names = tuple(dict.fromkeys(name for name, value in items))
+        self._values = {}  # lowercased name -> first value
+        for name, value in items:
+            self._values.setdefault(name.lower(), value)
+
+    def __getitem__(self, name):
+        try:
+            return self._values[name.lower()]
+        except KeyError:
+            raise KeyError(name) from None
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class _ParsedPart(dict):
+
+    """A :func:`parse_message` result (or one of its parts) which decodes
+    its ``'payload'`` from the email part on first access, so payloads of
+    mail that no tool accepts are never decoded.  The part is let go of
+    once it has been.
+
+    ``'payload'`` is always a member; anything that reads the values
+    (``items()``, ``copy()``, ``dict(part)``, ...) decodes it first.  That
+    means an undecodable payload fails when it's first used while routing
+    the message, not in :func:`parse_message`.
+
+    """
+
+    def __init__(self, part, **kw):
+        super().__init__(**kw)
+        if part.is_multipart():
+            # get_payload(decode=True) is always None for these, and the part holds all its subparts
+            self['payload'] = None
+            part = None
+        self._part = part
+
+    def _decode_payload(self):
+        if self._part is None:
+            return
+        payload = self._part.get_payload(decode=True)
+        # payload is sometimes already unicode (due to being saved in mongo?)
+        if self._part.get_content_maintype() == 'text':
+            payload = six.ensure_text(payload)
+        self['payload'] = payload
+        self._part = None
+
+    def __missing__(self, key):
+        if key != 'payload':
+            raise KeyError(key)
+        self._decode_payload()
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        if key == 'payload':
+            self._decode_payload()
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        return key == 'payload' or super().__contains__(key)
+
+    def __len__(self):
+        return super().__len__() + (self._part is not None)
+
+    def __iter__(self):
+        self._decode_payload()
+        return super().__iter__()
+
+    def __eq__(self, other):
+        self._decode_payload()
+        return super().__eq__(other)
+
+    def __repr__(self):
+        self._decode_payload()
+        return super().__repr__()
+
+    def keys(self):
+        self._decode_payload()
+        return super().keys()
+
+    def values(self):
+        self._decode_payload()
+        return super().values()
+
+    def items(self):
+        self._decode_payload()
+        return super().items()
+
+    def copy(self):
+        self._decode_payload()
+        return dict(self)
+
+
 def identify_sender(peer, email_address, headers, msg):
     from allura import model as M
     # Dumb ID -- just look for email address claimed by a particular user
-    addr = M.EmailAddress.get(email=email_address, confirmed=True)
+    # str() since a From with raw non-ascii text is parsed as an email.header.Header
+    from_address = str(headers.get('From', '')).strip() if headers else ''
+    arg_email = M.EmailAddress.canonical(email_address) if email_address else None
+    from_email = M.EmailAddress.canonical(from_address) if from_address else None
+    # fetch both candidates in one query, then prefer them in the same order as looking each one up
+    emails = [e for e in (arg_email, from_email) if e is not None]
+    addrs = M.EmailAddress.query.find({'email': {'$in': emails}}).all() if emails else []
+    addr = next((a for a in addrs if a.email == arg_email and a.confirmed), None)
     if addr and addr.claimed_by_user_id:
         return addr.claimed_by_user() or M.User.anonymous()
-    from_address = headers.get('From', '').strip()
     if not from_address:
         return M.User.anonymous()
-    addr = M.EmailAddress.get(email=from_address)
+    addr = next((a for a in addrs if a.email == from_email), None)
     if addr and addr.claimed_by_user_id:
         return addr.claimed_by_user() or M.User.anonymous()
     return M.User.anonymous()
 
 
 def encode_email_part(content, content_type):
-    try:
+    if content.isascii():
         # simplest email - plain ascii
         encoded_content = content.encode('ascii')
         encoding = 'ascii'
-        for line in encoded_content.splitlines():
-            if len(line) > MAX_MAIL_LINE_OCTETS:
-                # force base64 content-encoding to make lines shorter
-                encoding = 'utf-8'
-                break
-    except Exception:
+        if _has_long_line(encoded_content):
+            # force base64 content-encoding to make lines shorter
+            encoding = 'utf-8'
+    else:
         # utf8 will get base64 encoded so we only do it if ascii fails
         encoded_content = content.encode('utf-8')
         encoding = 'utf-8'
@@ -207,6 +371,22 @@ def encode_email_part(content, content_type):
     return MIMEText(encoded_content, content_type, encoding, policy=email_policy)
 
 
+def _has_long_line(content: bytes) -> bool:
+    # whether any line, split on \n and not counting the \r of \r\n, is longer than MAX_MAIL_LINE_OCTETS.
+    # Unlike content.splitlines() a bare \r doesn't split lines, so such content may count as long and get base64'd
+    start = 0
+    while True:
+        end = content.find(b'\n', start)
+        if end < 0:
+            end = len(content)
+        line_end = end - 1 if end > start and content[end - 1] == 13 else end  # don't count \r of \r\n
+        if line_end - start > MAX_MAIL_LINE_OCTETS:
+            return True
+        if end == len(content):
+            return False
+        start = end + 1
+
+
 def make_multipart_message(*parts):
     msg = MIMEMultipart('related', policy=email_policy)
     msg.preamble = 'This is a multi-part message in MIME format.'
@@ -220,15 +400,24 @@ def make_multipart_message(*parts):
 def _parse_message_id(msgid):
     if msgid is None:
         return []
+    if msgid.count('<') <= 1:
+        # the common case of a single <id>, no need for the regex
+        l = msgid.find('<')
+        r = msgid.find('>', l + 1)
+        if l < 0 or r < 0:
+            return []
+        return [msgid[l + 1:r].rsplit('/', 1)[-1]]
     return [mo.group(1)
             for mo in RE_MESSAGE_ID.finditer(msgid)]
 
 
 def _parse_smtp_addr(addr):
     addr = str(addr)
-    addrs = _parse_message_id(addr)
-    if addrs and addrs[0]:
-        return addrs[0]
+    if '<' in addr:
+        # "Name" <addr@example.com>
+        addrs = _parse_message_id(addr)
+        if addrs and addrs[0]:
+            return addrs[0]
     if '@' in addr:
         return addr
     return g.noreply
@@ -237,6 +426,9 @@ def _parse_smtp_addr(addr):
 def isvalid(addr):
     '''return True if addr is a (possibly) valid email address, false
     otherwise'''
+    if isinstance(addr, str) and addr.isascii():
+        # no idna encoding needed, so skip the validator machinery
+        return RE_EMAIL.fullmatch(addr.strip()) is not None
     try:
         EMAIL_VALIDATOR.to_python(addr, None)
         return True
@@ -244,10 +436,41 @@ def isvalid(addr):
         return False
 
 
+class _ChunkedData:
+
+    def data(self, msg: bytes):
+        '''Like :meth:`smtplib.SMTP.data`, but dot-stuffs and sends the message in chunks of whole lines,
+        instead of building several full-size copies of it first.  Takes the bytes sendmail() passes in.'''
+        self.putcmd('data')
+        code, repl = self.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, repl)
+        start = 0
+        while start < len(msg):
+            end = msg.find(b'\n', start + SMTP_DATA_CHUNK_SIZE)
+            end = len(msg) if end < 0 else end + 1
+            chunk = msg[start:end]
+            if chunk.startswith(b'.'):
+                chunk = b'.' + chunk
+            self.send(chunk.replace(b'\n.', b'\n..'))
+            start = end
+        self.send(b'.\r\n' if msg.endswith(b'\r\n') else b'\r\n.\r\n')
+        return self.getreply()
+
+
+class SMTP(_ChunkedData, smtplib.SMTP):
+    pass
+
+
+class SMTP_SSL(_ChunkedData, smtplib.SMTP_SSL):
+    pass
+
+
 class SMTPClient:
 
     def __init__(self):
         self._client = None
+        self._last_used = 0
 
     def sendmail(
             self, addrs, fromaddr, reply_to, subject, message_id, in_reply_to, message: EmailMessage,
@@ -275,20 +498,20 @@ class SMTPClient:
             if not references:
                 message['References'] = message['In-Reply-To']
         if references:
-            references = ['<%s>' % r for r in aslist(references)]
-            message['References'] = Header(*references)
+            message['References'] = ' '.join('<%s>' % r for r in aslist(references))
 
         # Kind of Hacky, but...
         #   Certain headers, like 'References' can become very long when sent via reply
-        #   from deep inside a ticket thread. message.as_string allows you to pass a
-        #   maxheaderlen which splits long lines for you to fit inside your exim constraints.
-        #   HOWEVER, that flag doesn't take the header name length into account. So, this
+        #   from deep inside a ticket thread. The policy's max_line_length splits long
+        #   lines for you to fit inside your exim constraints.
+        #   HOWEVER, that doesn't take the header name length into account. So, this
         #   somewhat hacky code approximates the longest 'Header-Name: ' prefix and makes sure
         #   the line octet length takes that into account.
-        longest_header_len = max(len(h[0]) for h in message._headers)
+        longest_header_len = max(len(name) for name in message.keys())
         max_header_len = MAX_MAIL_LINE_OCTETS - (2 + longest_header_len)
 
-        content = message.as_string(maxheaderlen=max_header_len)
+        # bytes go to the smtp server as-is, a str would be copied again to encode it
+        content = message.as_bytes(policy=email_policy.clone(max_line_length=max_header_len))
         smtp_addrs = list(map(_parse_smtp_addr, addrs))
         smtp_addrs = [a for a in smtp_addrs if isvalid(a)]
         if not smtp_addrs:
@@ -299,7 +522,7 @@ class SMTPClient:
         self.send_raw(config.return_path, smtp_addrs, content)
 
     def send_raw(self, addr_from, smtp_addrs, content):
-        if not self._client:
+        if not self._client or not self._is_alive():
             self._connect()
         try:
             self._client.sendmail(
@@ -323,17 +546,36 @@ class SMTPClient:
                 addr_from,
                 smtp_addrs,
                 content)
+        self._last_used = time.monotonic()
+
+    def _is_alive(self):
+        # the server may have dropped a connection that sat idle, check with a cheap NOOP
+        # instead of finding out from a failed (and retried) sendmail
+        if time.monotonic() - self._last_used < asint(tg.config.get('smtp_noop_interval', 30)):
+            return True
+        try:
+            self._client.noop()
+        except (smtplib.SMTPException, OSError) as e:
+            log.info(f'reconnecting after getting this smtp error on NOOP: {e!r}')
+            return False
+        return True
 
     def _connect(self):
+        if self._client:
+            # don't leave the old connection for the gc to close
+            try:
+                self._client.close()
+            except OSError:
+                pass
         log.info('connecting to SMTP server')
         if asbool(tg.config.get('smtp_ssl', False)):
-            smtp_client = smtplib.SMTP_SSL(
+            smtp_client = SMTP_SSL(
                 tg.config.get('smtp_server', 'localhost'),
                 asint(tg.config.get('smtp_port', 25)),
                 timeout=float(tg.config.get('smtp_timeout', 10)),
             )
         else:
-            smtp_client = smtplib.SMTP(
+            smtp_client = SMTP(
                 tg.config.get('smtp_server', 'localhost'),
                 asint(tg.config.get('smtp_port', 465)),
                 timeout=float(tg.config.get('smtp_timeout', 10)),
@@ -345,3 +587,4 @@ class SMTPClient:
         if asbool(tg.config.get('smtp_tls', False)):
             smtp_client.starttls()
         self._client = smtp_client
+        self._last_used = time.monotonic()
@@ -99,14 +99,13 @@ class RepositoryApp(Application):
                 SitemapEntry(menu_id, '.')[self.sidebar_menu()]]
 
     def admin_menu(self):
-        admin_url = c.project.url() + 'admin/' + \
-            self.config.options.mount_point + '/'
+        project_url = c.project.url()
+        mount_point = self.config.options.mount_point
+        admin_url = f'{project_url}admin/{mount_point}/'
         links = [
             SitemapEntry(
                 'Checkout URL',
-                c.project.url() + 'admin/' +
-                self.config.options.mount_point +
-                '/' + 'checkout_url',
+                admin_url + 'checkout_url',
                 className='admin_modal'),
             SitemapEntry(
                 'Viewable Files',
@@ -114,9 +113,7 @@ class RepositoryApp(Application):
                 className='admin_modal'),
             SitemapEntry(
                 'Refresh Repository',
-                c.project.url() +
-                self.config.options.mount_point +
-                '/refresh'),
+                f'{project_url}{mount_point}/refresh'),
         ]
         links += super().admin_menu()
         [links.remove(l) for l in links[:] if l.label == 'Options']
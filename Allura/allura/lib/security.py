@@ -71,6 +71,7 @@ class Credentials:
         'clear cache'
         self.users = {}
         self.projects = {}
+        self.app_visibility = {}  # (app_config_id, user_id) -> bool, see Application.is_visible_to
 
     def clear_user(self, user_id, project_id=None):
         if project_id == '*':
@@ -81,6 +82,16 @@ class Credentials:
         for uid, pid in to_remove:
             self.projects.pop(pid, None)
             self.users.pop((uid, pid), None)
+        self.app_visibility = {
+            key: visible for key, visible in self.app_visibility.items() if key[1] != user_id}
+
+    def clear_app_visibility(self, app_config_id=None):
+        'drop cached Application.is_visible_to results for one tool, or for all of them after a project ACL change'
+        if app_config_id is None:
+            self.app_visibility = {}
+        else:
+            self.app_visibility = {
+                key: visible for key, visible in self.app_visibility.items() if key[0] != app_config_id}
 
     def load_user_roles(self, user_id, *project_ids):
         '''Load the credentials with all user roles for a set of projects'''
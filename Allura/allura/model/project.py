@@ -491,6 +491,7 @@ class Project(SearchIndexable, MappedClass, ActivityNode, ActivityObject):
             self.acl.remove(ace)
         else:
             self.acl.append(ace)
+        g.credentials.clear_app_visibility()
     private = property(_get_private, _set_private)
 
     @property
@@ -28,7 +28,7 @@ from webob.exc import HTTPRequestEntityTooLarge
 from allura.lib import helpers as h
 from allura.lib.decorators import task
 from allura.lib.exceptions import CompoundError
-from allura.lib.solr import make_solr_from_config
+from allura.lib.solr import make_solr_from_config, escape_solr_arg
 import six
 
 if typing.TYPE_CHECKING:
@@ -37,6 +37,8 @@ if typing.TYPE_CHECKING:
 
 log = logging.getLogger(__name__)
 
+SOLR_DEL_TOOL_QUERY = 'project_id_s:"{project_id}" AND mount_point_s:"{mount_point}"'
+
 
 def __get_solr(solr_hosts=None):
     return make_solr_from_config(solr_hosts) if solr_hosts else g.solr
@@ -175,7 +177,9 @@ def commit():
 
 @task
 def solr_del_tool(project_id, mount_point_s):
-    g.solr.delete(q=f'project_id_s:"{project_id}" AND mount_point_s:"{mount_point_s}"')
+    g.solr.delete(q=SOLR_DEL_TOOL_QUERY.format(
+        project_id=escape_solr_arg(str(project_id)),
+        mount_point=escape_solr_arg(mount_point_s)))
 
 @contextmanager
 def _indexing_disabled(session):
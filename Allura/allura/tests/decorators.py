@@ -70,7 +70,7 @@ def with_tool(project_shortname, ep_name, mount_point=None, mount_label=None,
                     post_install_hook(c.app)
 
                 if asbool(tg.config.get('smtp.mock')):
-                    smtp_mock = patch('allura.lib.mail_util.smtplib.SMTP')
+                    smtp_mock = patch('allura.lib.mail_util.SMTP')
                 else:
                     smtp_mock = NullContextManager()
                 with smtp_mock:
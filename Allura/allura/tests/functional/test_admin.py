@@ -293,6 +293,44 @@ class TestProjectAdmin(TestController):
         for ace in old_acl:
             assert ace in app.acl
 
+    @td.with_wiki
+    def test_saving_unchanged_permissions(self):
+        def resubmit_permissions():
+            form = self.app.get('/admin/wiki/permissions').forms[1]
+            # as the browser does, submit the assigned roles without picking a new one
+            params = [(name, value) for name, value in form.submit_fields() if not name.endswith('.new')]
+            return self.app.post('/admin/wiki/update', params=params)
+
+        # first save stores every permission card on the tool explicitly
+        resubmit_permissions()
+        app = M.Project.query.get(shortname='test').app_instance('wiki')
+        old_acl = list(app.acl)
+        audit_count = M.AuditLog.query.find().count()
+        menu_updated = {
+            'task_name': 'allura.tasks.event_tasks.event',
+            'args': 'project_menu_updated'
+        }
+        menu_updated_count = M.MonQTask.query.find(menu_updated).count()
+
+        r = resubmit_permissions()
+        assert r.status_int == 302
+
+        # nothing changed, so nothing is rewritten, logged or announced
+        app = M.Project.query.get(shortname='test').app_instance('wiki')
+        assert list(app.acl) == old_acl
+        assert M.AuditLog.query.find().count() == audit_count
+        assert M.MonQTask.query.find(menu_updated).count() == menu_updated_count
+
+        # an ACE that only differs in its reason still counts as a change
+        ace = old_acl[0]
+        assert ace.access == M.ACE.ALLOW
+        app.config.acl = [M.ACE.allow(ace.role_id, ace.permission, 'stale')] + old_acl[1:]
+        ThreadLocalODMSession.flush_all()
+        resubmit_permissions()
+        app = M.Project.query.get(shortname='test').app_instance('wiki')
+        assert list(app.acl) == old_acl
+        assert M.MonQTask.query.find(menu_updated).count() == menu_updated_count + 1
+
     def test_tool_permissions(self):
         BUILTIN_APPS = ['activity', 'blog', 'discussion', 'git', 'link',
                         'shorturl', 'svn', 'tickets', 'userstats', 'wiki']
@@ -57,6 +57,20 @@ class TestApp:
         assert options[0].default == 'MyTestValue'
         assert options[1].default == 'MyTestValue'
 
+    def test_default_options(self):
+        counter = iter(range(10))
+
+        class TestApp(app.Application):
+            config_options = app.Application.config_options + [
+                app.ConfigOption('static', str, 'MyTestValue'),
+                app.ConfigOption('dynamic', int, lambda: next(counter))]
+
+        assert TestApp.default_options() == {
+            'mount_point': 'app', 'mount_label': 'app', 'ordinal': '0',
+            'static': 'MyTestValue', 'dynamic': 0}
+        assert TestApp.default_options()['dynamic'] == 1
+        assert 'static' not in app.Application.default_options()
+
     def test_config_options_render_attrs(self):
         opt = app.ConfigOption('test1', str, None, extra_attrs={'type': 'url'})
         assert opt.render_attrs() == 'type="url"'
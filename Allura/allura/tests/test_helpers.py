@@ -165,6 +165,24 @@ def test_make_app_admin_only():
     assert c.app.is_visible_to(admin)
 
 
+@td.with_wiki
+def test_app_visibility_follows_acl_changes():
+    # no Credentials.clear() between the checks, is_visible_to's cache has to notice on its own
+    h.set_context('test', 'wiki', neighborhood='Projects')
+    dev = M.User.query.get(username='test-user')
+    c.project.add_user(dev, ['Developer'])
+    c.app.acl.append(M.ACE.allow(M.ProjectRole.anonymous()._id, 'read'))
+    ThreadLocalODMSession.flush_all()
+    Credentials.get().clear()
+    assert c.app.is_visible_to(dev)
+    c.app.admin.block_user(username='test-user', perm='read')
+    assert not c.app.is_visible_to(dev)
+    c.app.admin.unblock_user(user_id=[str(dev._id)], perm='read')
+    assert c.app.is_visible_to(dev)
+    h.make_app_admin_only(c.app)
+    assert not c.app.is_visible_to(dev)
+
+
 @td.with_wiki
 def test_context_setters():
     h.set_context('test', 'wiki', neighborhood='Projects')
@@ -15,6 +15,8 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import smtplib
+import time
 import unittest
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -36,6 +38,9 @@ from allura.lib.mail_util import (
     identify_sender,
     _parse_message_id,
     email_policy,
+    isvalid,
+    SMTPClient,
+    SMTP,
 )
 from allura.lib.exceptions import AddressException
 from allura.tests import decorators as td
@@ -84,6 +89,23 @@ class TestReactor(unittest.TestCase):
         assert project.shortname == 'test'
         assert isinstance(app, Application)
 
+    @td.with_wiki
+    def test_parse_address_cached(self):
+        from allura.lib import helpers as h
+        with mock.patch.object(h, 'find_project', wraps=h.find_project) as find_project:
+            parse_address('foo@wiki.test.p' + config.common_suffix)
+            topic, project, app = parse_address('bar@wiki.test.p' + config.common_suffix)
+        assert find_project.call_count == 1
+        assert topic == 'bar'
+        assert project.shortname == 'test'
+        assert app.config.options.mount_point == 'wiki'
+
+        # a tool removed since it was cached is looked up again
+        project.uninstall_app('wiki')
+        ThreadLocalODMSession.flush_all()
+        with pytest.raises(AddressException):
+            parse_address('foo@wiki.test.p' + config.common_suffix)
+
     def test_unicode_simple_message(self):
         charset = 'utf-8'
         msg1 = MIMEText('''По оживлённым берегам
@@ -100,6 +122,55 @@ class TestReactor(unittest.TestCase):
         assert isinstance(msg2['payload'], str)
         assert 'всех' in msg2['payload']
 
+    @mock.patch('allura.lib.mail_util.PARSE_CHUNK_SIZE', 7)
+    def test_bytes_message_in_chunks(self):
+        msg1 = MIMEText('Толпой со всех концов земли\r\n' * 10, 'plain', 'utf-8', policy=email_policy)
+        msg1['Message-ID'] = '<foo@bar.com>'
+        msg2 = parse_message(msg1.as_bytes())
+        assert msg2['message_id'] == 'foo@bar.com'
+        assert msg2['payload'] == 'Толпой со всех концов земли\r\n' * 10
+
+    def test_payload_decoded_on_access(self):
+        msg1 = MIMEText('hello', 'plain', 'utf-8', policy=email_policy)
+        msg2 = parse_message(msg1.as_string())
+        assert 'payload' in msg2
+        assert msg2._part is not None  # not decoded yet
+        assert msg2.get('payload') == 'hello'
+        assert msg2['payload'] == 'hello'
+        assert msg2._part is None  # the parsed message isn't kept around any longer
+
+        # reading all the values decodes it too
+        assert dict(parse_message(msg1.as_string()))['payload'] == 'hello'
+        assert dict(parse_message(msg1.as_string()).items())['payload'] == 'hello'
+        assert parse_message(msg1.as_string()).copy()['payload'] == 'hello'
+        msg2 = parse_message(msg1.as_string())
+        assert len(msg2) == len(list(msg2))
+
+        msg1 = MIMEMultipart()
+        msg1.attach(MIMEText('hello', 'plain', 'utf-8', policy=email_policy))
+        container, text = parse_message(msg1.as_string())['parts']
+        assert container['payload'] is None
+        assert container._part is None
+        assert text['payload'] == 'hello'
+
+    def test_headers(self):
+        msg1 = MIMEText('hello', 'plain', 'utf-8', policy=email_policy)
+        msg1['Received'] = 'from a'
+        msg1['Received'] = 'from b'
+        msg1['Subject'] = 'Hi'
+        headers = parse_message(msg1.as_string())['headers']
+        assert headers['Subject'] == 'Hi'
+        assert headers['Received'] == 'from a'
+        assert headers['subject'] == 'Hi'
+        assert headers.get('X-Missing', 'default') == 'default'
+        assert dict(headers, Subject='Re: Hi') == {
+            'Content-Type': 'text/plain; charset="utf-8"',
+            'MIME-Version': '1.0',
+            'Content-Transfer-Encoding': 'base64',
+            'Received': 'from a',
+            'Subject': 'Re: Hi',
+        }
+
     def test_more_encodings(self):
         # these are unicode strings to reflect behavior after loading 'route_email' tasks from mongo
         s_msg = """Date: Sat, 25 May 2019 09:32:00 +1000
@@ -278,47 +349,62 @@ class TestIsAutoreply:
         self.msg['headers']['Return-Path'] = '<>'
         assert is_autoreply(self.msg)
 
+    def test_repeated_header(self):
+        msg = parse_message('Message-ID: <foo@bar.com>\n'
+                            'Delivered-To: Autoresponder\n'
+                            'Delivered-To: someone@example.com\n'
+                            '\n'
+                            'hi\n')
+        assert is_autoreply(msg)
+
 
 class TestIdentifySender:
 
     @mock.patch('allura.model.EmailAddress')
     def test_arg(self, EA):
         EA.canonical = lambda e: e
-        EA.get.side_effect = [
-            mock.Mock(claimed_by_user_id=True, claimed_by_user=lambda:'user')]
+        EA.query.find.return_value.all.return_value = [
+            mock.Mock(email='arg', confirmed=True, claimed_by_user_id=True, claimed_by_user=lambda:'user')]
         assert identify_sender(None, 'arg', None, None) == 'user'
-        EA.get.assert_called_once_with(email='arg', confirmed=True)
+        EA.query.find.assert_called_once_with({'email': {'$in': ['arg']}})
 
     @mock.patch('allura.model.EmailAddress')
     def test_header(self, EA):
         EA.canonical = lambda e: e
-        EA.get.side_effect = [
-            None, mock.Mock(claimed_by_user_id=True, claimed_by_user=lambda:'user')]
+        EA.query.find.return_value.all.return_value = [
+            mock.Mock(email='arg', confirmed=False, claimed_by_user_id=True, claimed_by_user=lambda:'arg-user'),
+            mock.Mock(email='from', confirmed=False, claimed_by_user_id=True, claimed_by_user=lambda:'user')]
         assert (
             identify_sender(None, 'arg', {'From': 'from'}, None) == 'user')
-        assert (EA.get.call_args_list ==
-                     [mock.call(email='arg', confirmed=True), mock.call(email='from')])
+        EA.query.find.assert_called_once_with({'email': {'$in': ['arg', 'from']}})
 
     @mock.patch('allura.model.User')
     @mock.patch('allura.model.EmailAddress')
     def test_no_header(self, EA, User):
         anon = User.anonymous()
         EA.canonical = lambda e: e
-        EA.get.side_effect = [
-            None, mock.Mock(claimed_by_user_id=True, claimed_by_user=lambda:'user')]
+        EA.query.find.return_value.all.return_value = [
+            mock.Mock(email='arg', confirmed=False, claimed_by_user_id=True, claimed_by_user=lambda:'user')]
         assert identify_sender(None, 'arg', {}, None) == anon
-        assert EA.get.call_args_list == [mock.call(email='arg', confirmed=True)]
+        EA.query.find.assert_called_once_with({'email': {'$in': ['arg']}})
 
     @mock.patch('allura.model.User')
     @mock.patch('allura.model.EmailAddress')
     def test_no_match(self, EA, User):
         anon = User.anonymous()
         EA.canonical = lambda e: e
-        EA.get.side_effect = [None, None]
+        EA.query.find.return_value.all.return_value = []
         assert (
             identify_sender(None, 'arg', {'From': 'from'}, None) == anon)
-        assert (EA.get.call_args_list ==
-                     [mock.call(email='arg', confirmed=True), mock.call(email='from')])
+        EA.query.find.assert_called_once_with({'email': {'$in': ['arg', 'from']}})
+
+    @mock.patch('allura.model.EmailAddress')
+    def test_non_ascii_header(self, EA):
+        EA.canonical = lambda e: e
+        EA.query.find.return_value.all.return_value = [
+            mock.Mock(email='arg', confirmed=True, claimed_by_user_id=True, claimed_by_user=lambda:'user')]
+        msg = parse_message('Message-ID: <foo@bar.com>\nFrom: Jörg <j@example.com>\n\nhi\n'.encode())
+        assert identify_sender(None, 'arg', msg['headers'], msg) == 'user'
 
 
 def test_parse_message_id():
@@ -326,6 +412,32 @@ def test_parse_message_id():
         'de31888f6be2d87dc377d9e713876bb514548625.patches@libjpeg-turbo.p.domain.net',
         'de31888f6be2d87dc377d9e713876bb514548625.patches@libjpeg-turbo.p.domain.net',
     ]
+    assert _parse_message_id('<abc@example.com>') == ['abc@example.com']
+    assert _parse_message_id('Re: </p/test/tickets/1/abc@example.com>') == ['abc@example.com']
+    assert _parse_message_id('abc@example.com') == []
+    assert _parse_message_id(None) == []
+    # unbalanced brackets don't make the regex backtrack over the rest of the header
+    assert _parse_message_id('<' * 20000 + '<a@b>') == ['a@b']
+
+
+@pytest.mark.parametrize('addr, valid', [
+    ('test@example.com', True),
+    (' test@example.com ', True),
+    ("o*reilly@test.com", True),
+    ('nobody@xn--m7r7ml7t24h.com', True),
+    ('тест@example.com', True),
+    ('test@пример.рф', True),
+    ('test', False),
+    ('test@example', False),
+    ('test@example.com.5', False),
+    ('test@.example.com', False),
+    ('test@example..com', False),
+    ('"Test" <test@example.com>', False),
+    ('5a5f1ed1e1382e13a5b5e8f5', False),
+    ('', False),
+])
+def test_isvalid(addr, valid):
+    assert isvalid(addr) is valid
 
 
 class TestMailServer:
@@ -341,3 +453,38 @@ class TestMailServer:
                                    'this is the email body with headers and everything ÎÅ¸'.encode())
         assert [] == log.exception.call_args_list
         assert log.info.call_args[0][0].startswith('Msg passed along as task '), log.info.call_args
+
+
+class TestSMTPClient:
+
+    def test_recently_used_connection(self):
+        client = SMTPClient()
+        client._client = mock.Mock()
+        client._last_used = time.monotonic()
+        with mock.patch.object(client, '_connect') as _connect:
+            client.send_raw('from@example.com', ['to@example.com'], b'content')
+        assert not client._client.noop.called
+        assert not _connect.called
+        client._client.sendmail.assert_called_once_with('from@example.com', ['to@example.com'], b'content')
+
+    def test_idle_connection_dropped(self):
+        client = SMTPClient()
+        client._client = idle_client = mock.Mock()
+        idle_client.noop.side_effect = smtplib.SMTPServerDisconnected()
+        with mock.patch('allura.lib.mail_util.SMTP') as SMTP:
+            new_client = SMTP.return_value
+            client.send_raw('from@example.com', ['to@example.com'], b'content')
+        assert idle_client.noop.called
+        assert not idle_client.sendmail.called
+        idle_client.close.assert_called_once_with()
+        new_client.sendmail.assert_called_once_with('from@example.com', ['to@example.com'], b'content')
+
+    @mock.patch('allura.lib.mail_util.SMTP_DATA_CHUNK_SIZE', 4)
+    def test_send_data(self):
+        smtp = mock.Mock()
+        smtp.getreply.side_effect = [(354, b'go ahead'), (250, b'ok')]
+        assert SMTP.data(smtp, b'Subject: hi\r\n\r\n.leading dot\r\nlast line') == (250, b'ok')
+        smtp.putcmd.assert_called_once_with('data')
+        sent = b''.join(args[0] for args, kwargs in smtp.send.call_args_list)
+        assert sent == b'Subject: hi\r\n\r\n..leading dot\r\nlast line\r\n.\r\n'
+        assert smtp.send.call_count > 2  # sent in chunks
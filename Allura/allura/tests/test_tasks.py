@@ -186,6 +186,12 @@ class TestIndexTasks:
             for project in projects:
                 assert project.index_id() in solr.delete.call_args[1]['q']
 
+    def test_solr_del_tool(self):
+        with mock.patch('allura.tasks.index_tasks.g.solr') as solr:
+            index_tasks.solr_del_tool('5d3f1a', 'my-wiki" OR *:*')
+            solr.delete.assert_called_once_with(
+                q=r'project_id_s:"5d3f1a" AND mount_point_s:"my\-wiki\" OR \*\:\*"')
+
     @td.with_wiki
     def test_add_artifacts(self):
         from allura.lib.search import find_shortlinks
@@ -267,7 +273,7 @@ class TestMailTasks:
                 message_id=h.gen_message_id())
             assert _client.sendmail.call_count == 1
             return_path, rcpts, body = _client.sendmail.call_args[0]
-            body = body.split(email_policy.linesep)
+            body = body.decode().split(email_policy.linesep)
 
             assert rcpts == [c.user.get_pref('email_address')]
             assert 'Reply-To: %s' % g.noreply in body
@@ -290,7 +296,7 @@ class TestMailTasks:
                 message_id=h.gen_message_id())
             assert _client.sendmail.call_count == 1
             return_path, rcpts, body = _client.sendmail.call_args[0]
-            body = body.split(email_policy.linesep)
+            body = body.decode().split(email_policy.linesep)
 
             assert rcpts == ['blah@blah.com']
             assert 'Reply-To: %s' % g.noreply in body
@@ -322,7 +328,7 @@ class TestMailTasks:
                 message_id=h.gen_message_id())
             assert _client.sendmail.call_count == 1
             return_path, rcpts, body = _client.sendmail.call_args[0]
-            body = body.split(email_policy.linesep)
+            body = body.decode().split(email_policy.linesep)
             assert 'From: %s' % g.noreply in body
 
     def test_send_email_with_disabled_destination_user(self):
@@ -353,7 +359,7 @@ class TestMailTasks:
                 message_id=h.gen_message_id())
             assert _client.sendmail.call_count == 1
             return_path, rcpts, body = _client.sendmail.call_args[0]
-            body = body.split(email_policy.linesep)
+            body = body.decode().split(email_policy.linesep)
             assert 'From: "Test Admin" <test-admin@users.localhost>' in body
 
             c.user.disabled = True
@@ -367,7 +373,7 @@ class TestMailTasks:
                 message_id=h.gen_message_id())
             assert _client.sendmail.call_count == 2
             return_path, rcpts, body = _client.sendmail.call_args[0]
-            body = body.split(email_policy.linesep)
+            body = body.decode().split(email_policy.linesep)
             assert 'From: %s' % g.noreply in body
 
     def test_email_sender_to_headers(self):
@@ -383,7 +389,7 @@ class TestMailTasks:
                 message_id=h.gen_message_id())
             assert _client.sendmail.call_count == 1
             return_path, rcpts, body = _client.sendmail.call_args[0]
-            body = body.split(email_policy.linesep)
+            body = body.decode().split(email_policy.linesep)
             assert 'From: "Test Admin" <test-admin@users.localhost>' in body
             assert 'Sender: tickets@test.p.domain.net' in body
             assert 'To: test@mail.com' in body
@@ -399,7 +405,7 @@ class TestMailTasks:
                 message_id=h.gen_message_id())
             assert _client.sendmail.call_count == 1
             return_path, rcpts, body = _client.sendmail.call_args[0]
-            body = body.split(email_policy.linesep)
+            body = body.decode().split(email_policy.linesep)
             assert 'From: "Test Admin" <test-admin@users.localhost>' in body
             assert 'Sender: tickets@test.p.domain.net' in body
             assert 'To: 123@tickets.test.p.domain.net' in body
@@ -417,7 +423,7 @@ class TestMailTasks:
                 message_id=h.gen_message_id())
             assert _client.sendmail.call_count == 1
             return_path, rcpts, body = _client.sendmail.call_args[0]
-            body = body.split(email_policy.linesep)
+            body = body.decode().split(email_policy.linesep)
             assert 'From: "Test Admin" <test-admin@users.localhost>' in body
             assert 'References: <a> <b> <c>' in body
 
@@ -432,7 +438,7 @@ class TestMailTasks:
                 message_id=h.gen_message_id())
             assert _client.sendmail.call_count == 1
             return_path, rcpts, body = _client.sendmail.call_args[0]
-            body = body.split(email_policy.linesep)
+            body = body.decode().split(email_policy.linesep)
             assert 'From: "Test Admin" <test-admin@users.localhost>' in body
             assert 'References: <ref>' in body
 
@@ -449,7 +455,7 @@ class TestMailTasks:
                 message_id=h.gen_message_id())
             assert _client.sendmail.call_count == 1
             return_path, rcpts, body = _client.sendmail.call_args[0]
-            assert 'CC: someone@example.com' in body
+            assert b'CC: someone@example.com' in body
             assert 'someone@example.com' in rcpts
 
     def test_fromaddr_objectid_not_str(self):
@@ -464,7 +470,7 @@ class TestMailTasks:
                 message_id=h.gen_message_id())
             assert _client.sendmail.call_count == 1
             return_path, rcpts, body = _client.sendmail.call_args[0]
-            assert 'From: "Test Admin" <test-admin@users.localhost>' in body
+            assert b'From: "Test Admin" <test-admin@users.localhost>' in body
 
     @pytest.mark.parametrize('bodychars', [
         '0123456789',  # plain ascii is handled different since it doesn't necessarily need to be encoded
@@ -481,12 +487,12 @@ class TestMailTasks:
                 references=['foo@example.com'] * 100,  # needs to handle really long headers as well
                 message_id=h.gen_message_id())
             return_path, rcpts, body = _client.sendmail.call_args[0]
-            body_lines = body.split(email_policy.linesep)
+            body_lines = body.split(email_policy.linesep.encode())
 
             for line in body_lines:
                 assert len(line) <= MAX_MAIL_LINE_OCTETS
 
-            msg = email.parser.Parser().parsestr(body)
+            msg = email.parser.BytesParser().parsebytes(body)
             plain_subpart = next(email.iterators.typed_subpart_iterator(msg, 'text', 'plain'))
             plain = plain_subpart.get_payload(decode=True).decode('utf-8')
             html_subpart = next(email.iterators.typed_subpart_iterator(msg, 'text', 'html')).get_payload(decode=True)
@@ -17,12 +17,15 @@
 
 from unittest import TestCase
 
+from ming.odm import ThreadLocalODMSession
+from tg import tmpl_context as c
+
 from allura.app import Application
 from allura import model
 from allura.lib import helpers as h
 from allura.tests.unit import WithDatabase
 from allura.tests.unit.patches import fake_app_patch
-from allura.tests.unit.factories import create_project, create_app_config
+from allura.tests.unit.factories import create_project, create_app_config, create_post
 
 
 class TestApplication(TestCase):
@@ -52,6 +55,18 @@ class TestApplication(TestCase):
         self.assertEqual(f('admin'), 'Set permissions.')
         self.assertEqual(f('does_not_exist'), '')
 
+    def test_describe_permission_cached_per_class(self):
+        class DummyApp(Application):
+            permissions_desc = {'foo': 'bar'}
+
+        class DummySubApp(DummyApp):
+            permissions_desc = {'foo': 'baz'}
+
+        self.assertEqual(DummyApp.describe_permission('foo'), 'bar')
+        self.assertEqual(DummySubApp.describe_permission('foo'), 'baz')
+        self.assertEqual(DummyApp.describe_permission('foo'), 'bar')
+        self.assertEqual(Application.describe_permission('foo'), '')
+
 
 class TestInstall(WithDatabase):
     patches = [fake_app_patch]
@@ -65,6 +80,32 @@ class TestInstall(WithDatabase):
         return model.Discussion.query.find().count()
 
 
+class TestUninstall(WithDatabase):
+    patches = [fake_app_patch]
+
+    def test_that_it_removes_discussions(self):
+        post = create_post('mypost')
+        app = Application(c.app.config.project, c.app.config)
+        app.uninstall(c.app.config.project)
+        assert model.Discussion.query.find(dict(_id=post.discussion_id)).count() == 0
+        assert model.Thread.query.find(dict(_id=post.thread_id)).count() == 0
+        assert model.Post.query.find(dict(_id=post._id)).count() == 0
+
+    def test_that_it_removes_refs_and_shortlinks(self):
+        post = create_post('mypost')
+        model.ArtifactReference.from_artifact(post)
+        model.Shortlink.from_artifact(post)
+        ThreadLocalODMSession.flush_all()
+        refs = {'artifact_reference.app_config_id': c.app.config._id}
+        shortlinks = {'app_config_id': c.app.config._id}
+        assert model.ArtifactReference.query.find(refs).count()
+        assert model.Shortlink.query.find(shortlinks).count()
+        app = Application(c.app.config.project, c.app.config)
+        app.uninstall(c.app.config.project)
+        assert model.ArtifactReference.query.find(refs).count() == 0
+        assert model.Shortlink.query.find(shortlinks).count() == 0
+
+
 class TestDefaultDiscussion(WithDatabase):
     patches = [fake_app_patch]
 